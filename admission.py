@@ -0,0 +1,278 @@
+"""
+Admission control for the conversion routes.
+
+Each client gets a token bucket, and a global cap limits how many
+conversions run at once. Requests are charged an estimated cost, so large
+uploads use more of the budget. State is kept in a local SQLite file so
+that all gunicorn workers on the machine share the same limits.
+
+Rejected requests get 429 (client over its rate) or 503 (server busy),
+both with a Retry-After header.
+"""
+
+import functools
+import logging
+import math
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+ADMISSION_DB = os.environ.get(
+    'ADMISSION_DB',
+    os.path.join(tempfile.gettempdir(), 'pianotour_admission.sqlite3'))
+# Tokens refilled per second and bucket size, per client
+ADMISSION_RATE = float(os.environ.get('ADMISSION_RATE', 0.5))
+ADMISSION_BURST = float(os.environ.get('ADMISSION_BURST', 10))
+# Conversions allowed to run at the same time across all workers
+MAX_CONCURRENT_CONVERSIONS = int(os.environ.get('MAX_CONCURRENT_CONVERSIONS', 2))
+# Slots older than this are assumed to belong to a killed worker
+SLOT_TIMEOUT = 300.0
+# A streamed response gives its slot back after this long even if the client
+# is still reading, so slow readers cannot hold every slot
+STREAM_SLOT_TIME_LIMIT = float(os.environ.get('STREAM_SLOT_TIME_LIMIT', 30))
+BUCKET_IDLE_TIMEOUT = 3600.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    client TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS slots (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    pid INTEGER NOT NULL,
+    started REAL NOT NULL
+);
+"""
+
+
+class Decision:
+    """Result of an admission check."""
+
+    __slots__ = ('admitted', 'status', 'retry_after', 'slot_id')
+
+    def __init__(self, admitted, status=200, retry_after=0, slot_id=None):
+        self.admitted = admitted
+        self.status = status
+        self.retry_after = retry_after
+        self.slot_id = slot_id
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class AdmissionController:
+    """
+    Token buckets and a global concurrency cap stored in a SQLite file.
+
+    Args:
+        db_path (str): SQLite file shared by all worker processes
+        rate (float): Tokens added to each bucket per second
+        burst (float): Bucket capacity
+        max_concurrent (int): Global cap on running conversions
+    """
+
+    def __init__(self, db_path=ADMISSION_DB, rate=ADMISSION_RATE,
+                 burst=ADMISSION_BURST,
+                 max_concurrent=MAX_CONCURRENT_CONVERSIONS):
+        self.db_path = db_path
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrent = max_concurrent
+        self._local = threading.local()
+
+    def _connection(self):
+        # Connections are per thread and per process (not shared across fork)
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=5.0,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(_SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def acquire(self, client, cost):
+        """
+        Charge `cost` tokens to `client` and take a conversion slot.
+
+        Returns:
+            Decision: admitted with a slot_id to release, or rejected with
+                the HTTP status and Retry-After seconds
+        """
+        cost = min(max(cost, 0.0), self.burst)
+        now = time.time()
+        try:
+            conn = self._connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                decision = self._acquire(conn, client, cost, now)
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+        except sqlite3.Error as e:
+            # Fail open: a broken limiter store should not take the site down
+            logger.warning(f"Admission control unavailable: {e}")
+            return Decision(True)
+        return decision
+
+    def _acquire(self, conn, client, cost, now):
+        row = conn.execute('SELECT tokens, updated FROM buckets WHERE client = ?',
+                           (client, )).fetchone()
+        if row is None:
+            tokens = self.burst
+        else:
+            tokens = min(self.burst, row[0] + (now - row[1]) * self.rate)
+
+        if tokens < cost:
+            retry_after = math.ceil((cost - tokens) / self.rate)
+            return Decision(False, 429, max(1, retry_after))
+
+        conn.execute('DELETE FROM slots WHERE started < ?', (now - SLOT_TIMEOUT, ))
+        slots = conn.execute('SELECT id, pid FROM slots').fetchall()
+        if len(slots) >= self.max_concurrent:
+            # Drop slots held by workers that died without releasing them
+            dead = [(slot_id, ) for slot_id, pid in slots if not _pid_alive(pid)]
+            if dead:
+                conn.executemany('DELETE FROM slots WHERE id = ?', dead)
+            if len(slots) - len(dead) >= self.max_concurrent:
+                return Decision(False, 503, 1)
+
+        conn.execute(
+            'INSERT OR REPLACE INTO buckets (client, tokens, updated) VALUES (?, ?, ?)',
+            (client, tokens - cost, now))
+        slot_id = conn.execute('INSERT INTO slots (pid, started) VALUES (?, ?)',
+                               (os.getpid(), now)).lastrowid
+
+        # Occasionally forget clients whose buckets have refilled long ago
+        if random.random() < 0.01:
+            conn.execute('DELETE FROM buckets WHERE updated < ?',
+                         (now - BUCKET_IDLE_TIMEOUT, ))
+
+        return Decision(True, slot_id=slot_id)
+
+    def release(self, slot_id):
+        if slot_id is None:
+            return
+        try:
+            self._connection().execute('DELETE FROM slots WHERE id = ?', (slot_id, ))
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to release conversion slot: {e}")
+
+
+def client_id(request):
+    """Identify the client, using the address Fly.io forwards if present."""
+    return request.headers.get('Fly-Client-IP') or request.remote_addr or 'unknown'
+
+
+_END = object()
+
+
+class _SlotRelease:
+    """Releases a conversion slot once, whichever caller gets there first."""
+
+    def __init__(self, controller, slot_id):
+        self._controller = controller
+        self._slot_id = slot_id
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def release_after(self, seconds):
+        self._timer = threading.Timer(seconds, self)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def __call__(self):
+        with self._lock:
+            slot_id, self._slot_id = self._slot_id, None
+        if self._timer is not None:
+            self._timer.cancel()
+        self._controller.release(slot_id)
+
+
+def _release_when_exhausted(body, release):
+    """
+    Yield from `body`, releasing the slot as soon as its last chunk has been
+    produced. Reads one chunk ahead, so the release does not wait for the
+    client to receive the last chunk.
+    """
+    chunks = iter(body)
+    try:
+        chunk = next(chunks, _END)
+        while chunk is not _END:
+            following = next(chunks, _END)
+            if following is _END:
+                release()
+            yield chunk
+            chunk = following
+    finally:
+        release()
+        close = getattr(body, 'close', None)
+        if close is not None:
+            close()
+
+
+def admission_controlled(controller, estimate_cost):
+    """
+    Decorate a Flask view so it runs only when admitted by `controller`.
+
+    The conversion slot is released when the view returns. For generated
+    (streamed) responses it is released once the body has produced its last
+    chunk, after STREAM_SLOT_TIME_LIMIT seconds, or when the response is
+    closed, whichever comes first.
+
+    Args:
+        controller (AdmissionController): Shared limiter
+        estimate_cost (callable): Returns the token cost of the current request
+    """
+    from flask import jsonify, make_response, request
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            decision = controller.acquire(client_id(request), estimate_cost(request))
+            if not decision.admitted:
+                if decision.status == 429:
+                    message = 'Too many conversion requests, please slow down'
+                else:
+                    message = 'Server is busy, please try again shortly'
+                response = jsonify({'error': message})
+                response.status_code = decision.status
+                response.headers['Retry-After'] = str(decision.retry_after)
+                return response
+            try:
+                response = make_response(view(*args, **kwargs))
+            except BaseException:
+                controller.release(decision.slot_id)
+                raise
+            # Generated bodies are produced after the view returns, so the
+            # slot is held while they are generated. Files passed through
+            # as-is are already converted (and skip close callbacks)
+            if response.is_streamed and not response.direct_passthrough:
+                release = _SlotRelease(controller, decision.slot_id)
+                release.release_after(STREAM_SLOT_TIME_LIMIT)
+                response.response = _release_when_exhausted(
+                    response.response, release)
+                response.call_on_close(release)
+            else:
+                controller.release(decision.slot_id)
+            return response
+
+        return wrapper
+
+    return decorator
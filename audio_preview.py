@@ -0,0 +1,319 @@
+"""
+Server-side audio previews rendered from the static/samples library.
+
+Used by the /render-preview route for clients that cannot run the
+in-browser synth. Notes are rendered with NumPy: every distinct
+(pitch, length, velocity) voice is pitch-shifted and enveloped once as a
+whole-buffer operation, then added into the output at each of its start
+positions.
+"""
+
+import hashlib
+import io
+import os
+import struct
+import wave
+from functools import lru_cache
+
+import numpy as np
+import ugly_midi
+
+SAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'static', 'samples')
+
+# Output format: mono WAV at a reduced sample rate. 8-bit G.711 mu-law is
+# the default, at 22 KB per second (0.66 MB for a full 30 s preview) with
+# telephone-grade quantization noise; 16-bit PCM doubles that (1.32 MB).
+# WAV audio barely shrinks under gzip, so it is not compressed in transit.
+PREVIEW_SAMPLE_RATE = 22050
+WAV_ENCODINGS = ('mulaw', 'pcm')
+DEFAULT_WAV_ENCODING = 'mulaw'
+WAVE_FORMAT_MULAW = 7
+MAX_PREVIEW_SECONDS = 30.0
+MASTER_GAIN = 0.5
+
+# Mirrors the sample maps and envelopes of InstrumentControl in
+# static/js/core/audioManager.js
+INSTRUMENT_SAMPLES = {
+    'piano': {
+        'samples': {
+            'C2': 'SteinwayD_m_C2_L.wav',
+            'E2': 'SteinwayD_m_E2_L.wav',
+            'G#2': 'SteinwayD_m_G#2_L.wav',
+            'C3': 'SteinwayD_m_C3_L.wav',
+            'E3': 'SteinwayD_m_E3_L.wav',
+            'G#3': 'SteinwayD_m_G#3_L.wav',
+            'C4': 'SteinwayD_m_C4_L.wav',
+            'E4': 'SteinwayD_m_E4_L.wav',
+            'F#4': 'SteinwayD_m_F#4_L.wav',
+            'A#4': 'SteinwayD_m_A#4_L.wav',
+            'C5': 'SteinwayD_m_C5_L.wav',
+            'F#5': 'SteinwayD_m_F#5_L.wav',
+            'C6': 'SteinwayD_m_C6_L.wav',
+        },
+        'envelope': {'attack': 0.01, 'decay': 0.3, 'sustain': 0.8, 'release': 1.2},
+    },
+    'guitar': {
+        'samples': {
+            'F#2': 'nylonf42.wav',
+            'C3': 'nylonf48.wav',
+            'F3': 'nylonf53.wav',
+            'A#3': 'nylonf58.wav',
+            'D4': 'nylonf62.wav',
+            'G#4': 'nylonf68.wav',
+            'C#5': 'nylonf73.wav',
+            'G5': 'nylonf79.wav',
+        },
+        'envelope': {'attack': 0.02, 'decay': 0.5, 'sustain': 0.9, 'release': 2.0},
+    },
+    'cello': {
+        'samples': {
+            'D2': 'CelloD2.wav',
+            'C3': 'CelloC3.wav',
+            'E3': 'CelloE3.wav',
+            'A3': 'CelloA3.wav',
+            'C4': 'CelloC4.wav',
+            'D#4': 'CelloD#4.wav',
+            'F#4': 'CelloF#4.wav',
+            'G#4': 'CelloG#4.wav',
+            'A4': 'CelloA4.wav',
+            'C5': 'CelloC5.wav',
+        },
+        'envelope': {'attack': 0.03, 'decay': 0.2, 'sustain': 0.95, 'release': 1.5},
+    },
+    'sax': {
+        'samples': {
+            'A2': 'TSAX45-2.wav',
+            'C#3': 'TSAX49.wav',
+            'F3': 'TSAX53-3.wav',
+            'A3': 'TSAX57.wav',
+            'C4': 'TSAX60-3.wav',
+            'D4': 'TSAX62-2.wav',
+            'F4': 'TSAX65-2.wav',
+            'G#4': 'TSAX68.wav',
+            'A4': 'TSAX69-3.wav',
+            'C5': 'TSAX72.wav',
+            'F#5': 'TSAX78-2.wav',
+            'A#5': 'TSAX82-2.wav',
+            'C6': 'TSAX84-2.wav',
+        },
+        'envelope': {'attack': 0.03, 'decay': 0.2, 'sustain': 1.0, 'release': 0.8},
+    },
+}
+INSTRUMENT_SAMPLES['saxophone'] = INSTRUMENT_SAMPLES['sax']
+
+_SAMPLE_DTYPES = {1: np.uint8, 2: np.int16, 4: np.int32}
+
+
+@lru_cache(maxsize=None)
+def load_sample(file_name):
+    """
+    Decode a sample to mono float32 at PREVIEW_SAMPLE_RATE.
+
+    Decoded samples stay cached in memory for the life of the process.
+    """
+    path = os.path.join(SAMPLES_DIR, file_name)
+    with wave.open(path, 'rb') as wav:
+        channels = wav.getnchannels()
+        sample_width = wav.getsampwidth()
+        frame_rate = wav.getframerate()
+        frames = wav.readframes(wav.getnframes())
+
+    dtype = _SAMPLE_DTYPES.get(sample_width)
+    if dtype is None:
+        raise ValueError(f"Unsupported sample width {sample_width} in {file_name}")
+
+    data = np.frombuffer(frames, dtype=dtype).astype(np.float32)
+    if sample_width == 1:
+        data = (data - 128.0) / 128.0
+    else:
+        data /= float(2 ** (8 * sample_width - 1))
+    data = data.reshape(-1, channels).mean(axis=1)
+
+    if frame_rate != PREVIEW_SAMPLE_RATE:
+        duration = len(data) / frame_rate
+        positions = np.arange(int(duration * PREVIEW_SAMPLE_RATE)) * (frame_rate / PREVIEW_SAMPLE_RATE)
+        data = np.interp(positions, np.arange(len(data)), data).astype(np.float32)
+
+    data.setflags(write=False)
+    return data
+
+
+@lru_cache(maxsize=None)
+def _sample_roots(instrument):
+    """Return sorted (midi_note, file_name) pairs for an instrument."""
+    samples = INSTRUMENT_SAMPLES[instrument]['samples']
+    return tuple(sorted((ugly_midi.parse_note_name(name)[0], file_name)
+                        for name, file_name in samples.items()))
+
+
+def _nearest_sample(instrument, pitch):
+    roots = _sample_roots(instrument)
+    return min(roots, key=lambda root: abs(root[0] - pitch))
+
+
+def _envelope(length, hold, envelope):
+    """ADSR gain curve of `length` frames with the release starting at `hold`."""
+    rate = PREVIEW_SAMPLE_RATE
+    t = np.arange(length, dtype=np.float32) / rate
+    attack = max(envelope['attack'], 1.0 / rate)
+    decay = max(envelope['decay'], 1.0 / rate)
+    sustain = envelope['sustain']
+    release = max(envelope['release'], 1.0 / rate)
+
+    gain = np.where(
+        t < attack, t / attack,
+        np.where(t < attack + decay,
+                 1.0 - (1.0 - sustain) * (t - attack) / decay,
+                 sustain)).astype(np.float32)
+
+    hold_time = hold / rate
+    level_at_release = float(np.interp(hold_time, t, gain)) if length else 0.0
+    release_curve = level_at_release * np.clip(1.0 - (t - hold_time) / release, 0.0, 1.0)
+    return np.where(t < hold_time, gain, release_curve).astype(np.float32)
+
+
+def _render_voice(instrument, pitch, hold, velocity):
+    """Pitch-shift, envelope and scale one voice; returns a float32 buffer."""
+    envelope = INSTRUMENT_SAMPLES[instrument]['envelope']
+    root, file_name = _nearest_sample(instrument, pitch)
+    sample = load_sample(file_name)
+
+    ratio = 2.0 ** ((pitch - root) / 12.0)
+    length = hold + int(envelope['release'] * PREVIEW_SAMPLE_RATE)
+    length = min(length, int((len(sample) - 1) / ratio))
+    if length <= 0:
+        return np.zeros(0, dtype=np.float32)
+
+    positions = np.arange(length, dtype=np.float32) * ratio
+    voice = np.interp(positions, np.arange(len(sample), dtype=np.float32), sample)
+    gain = MASTER_GAIN * (velocity / 127.0)
+    return (voice * _envelope(length, hold, envelope) * gain).astype(np.float32)
+
+
+def render_preview(song_data, max_seconds=MAX_PREVIEW_SECONDS):
+    """
+    Render a sanitized song object to mono float32 audio.
+
+    Args:
+        song_data (dict): Song object as accepted by /convert-to-midi
+        max_seconds (float): Length limit of the preview
+
+    Returns:
+        numpy.ndarray: Audio in the range [-1, 1] at PREVIEW_SAMPLE_RATE
+
+    Raises:
+        ValueError: If there are no samples for the song's instrument
+    """
+    instrument = str(song_data.get('instrument', 'piano')).lower()
+    if instrument not in INSTRUMENT_SAMPLES:
+        raise ValueError(f"No preview samples for instrument '{instrument}'")
+
+    tempo = song_data.get('tempo', 120)
+    time_signature = song_data.get('timeSignature', {'numerator': 4, 'denominator': 4})
+    notes_by_clef, _ = ugly_midi.converter.process_measures(
+        song_data.get('measures', []), tempo, time_signature)
+
+    rate = PREVIEW_SAMPLE_RATE
+    total_frames = int(max_seconds * rate)
+
+    # Group notes that share the same rendered voice
+    voices = {}
+    for notes in notes_by_clef.values():
+        for note in notes:
+            start = int(round(note.start_time * rate))
+            if start >= total_frames:
+                continue
+            hold = max(1, int(round((note.end_time - note.start_time) * rate)))
+            voices.setdefault((note.midi_note, hold, note.velocity), []).append(start)
+
+    if not voices:
+        return np.zeros(0, dtype=np.float32)
+
+    end_frame = 0
+    rendered = []
+    for (pitch, hold, velocity), starts in voices.items():
+        voice = _render_voice(instrument, pitch, hold, velocity)
+        if not len(voice):
+            continue
+        rendered.append((voice, starts))
+        end_frame = max(end_frame, max(starts) + len(voice))
+
+    output = np.zeros(min(end_frame, total_frames), dtype=np.float32)
+    for voice, starts in rendered:
+        # The voice is rendered once and added at each of its start positions
+        for start in starts:
+            end = min(start + len(voice), len(output))
+            output[start:end] += voice[:end - start]
+
+    # Simple peak limiter so dense chords do not clip
+    peak = float(np.abs(output).max()) if len(output) else 0.0
+    if peak > 1.0:
+        output /= peak
+    return output
+
+
+@lru_cache(maxsize=None)
+def renderer_version():
+    """
+    Identify the renderer code and sample library for caches of previews.
+
+    Returns:
+        str: Hash of this module's source and of the sample file names and sizes
+    """
+    digest = hashlib.sha256()
+    with open(os.path.abspath(__file__), 'rb') as f:
+        digest.update(f.read())
+    if os.path.isdir(SAMPLES_DIR):
+        for name in sorted(os.listdir(SAMPLES_DIR)):
+            size = os.path.getsize(os.path.join(SAMPLES_DIR, name))
+            digest.update(f'{name}:{size}\0'.encode('utf-8'))
+    return digest.hexdigest()[:12]
+
+
+def supports_instrument(instrument):
+    return str(instrument).lower() in INSTRUMENT_SAMPLES
+
+
+def _mulaw(audio):
+    """Quantize float audio to G.711 mu-law bytes."""
+    pcm = (np.clip(audio, -1.0, 1.0) * 32767.0).astype(np.int32)
+    sign = np.where(pcm < 0, 0x80, 0)
+    magnitude = np.minimum(np.abs(pcm), 32635) + 0x84
+    exponent = np.floor(np.log2(magnitude)).astype(np.int32) - 7
+    mantissa = (magnitude >> (exponent + 3)) & 0x0F
+    return (~(sign | (exponent << 4) | mantissa) & 0xFF).astype(np.uint8)
+
+
+def encode_wav(audio, encoding=DEFAULT_WAV_ENCODING):
+    """
+    Encode mono float32 audio as WAV bytes.
+
+    Args:
+        audio (numpy.ndarray): Audio at PREVIEW_SAMPLE_RATE
+        encoding (str): 'mulaw' for 8-bit mu-law or 'pcm' for 16-bit PCM
+
+    Returns:
+        bytes: WAV file
+    """
+    if encoding == 'mulaw':
+        # The wave module only writes PCM, so the header is built by hand
+        data = _mulaw(audio).tobytes()
+        fmt = struct.pack('<HHIIHHH', WAVE_FORMAT_MULAW, 1,
+                          PREVIEW_SAMPLE_RATE, PREVIEW_SAMPLE_RATE, 1, 8, 0)
+        fact = struct.pack('<I', len(audio))
+        padding = b'\x00' * (len(data) % 2)
+        chunks = (b'fmt ' + struct.pack('<I', len(fmt)) + fmt +
+                  b'fact' + struct.pack('<I', len(fact)) + fact +
+                  b'data' + struct.pack('<I', len(data)) + data + padding)
+        return b'RIFF' + struct.pack('<I', 4 + len(chunks)) + b'WAVE' + chunks
+
+    pcm = (np.clip(audio, -1.0, 1.0) * 32767.0).astype('<i2')
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(PREVIEW_SAMPLE_RATE)
+        wav.writeframes(pcm.tobytes())
+    return buffer.getvalue()
+
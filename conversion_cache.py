@@ -0,0 +1,179 @@
+"""
+Persistent conversion cache shared by all workers.
+
+Conversion results are stored in a SQLite file under CONVERSION_CACHE_DIR,
+keyed by a hash of the input and of the converter code, so a warm cache
+survives restarts and is shared by every gunicorn worker. The cache is
+bounded in size and evicts the least recently used entries first.
+
+The default directory is under the system temp directory, which does not
+survive a restart on Fly.io. fly.toml mounts a volume at /data and points
+CONVERSION_CACHE_DIR there; other deployments need an equivalent mount.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+import ugly_midi
+
+logger = logging.getLogger(__name__)
+
+CONVERSION_CACHE_DIR = os.environ.get(
+    'CONVERSION_CACHE_DIR',
+    os.path.join(tempfile.gettempdir(), 'pianotour_cache'))
+CONVERSION_CACHE_MAX_BYTES = int(
+    os.environ.get('CONVERSION_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+# Access times are refreshed at most this often, to avoid a write per hit
+ACCESS_UPDATE_INTERVAL = 60.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+"""
+
+
+class ConversionCache:
+    """
+    Size-bounded LRU store of conversion results in a SQLite file.
+
+    Args:
+        directory (str): Directory holding the cache database
+        max_bytes (int): Total size of cached values before eviction
+    """
+
+    def __init__(self, directory=CONVERSION_CACHE_DIR,
+                 max_bytes=CONVERSION_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.db_path = os.path.join(directory, 'conversions.sqlite3')
+        self.max_bytes = max_bytes
+        self.version = ugly_midi.converter_version()
+        self._local = threading.local()
+
+    def _connection(self):
+        # Connections are per thread and per process (not shared across fork)
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            os.makedirs(self.directory, exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=5.0,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(_SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def make_key(self, namespace, data):
+        """Hash input bytes together with the namespace and converter version."""
+        digest = hashlib.sha256()
+        digest.update(f'{namespace}\0{self.version}\0'.encode('utf-8'))
+        digest.update(data)
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Return the cached bytes for `key`, or None."""
+        try:
+            conn = self._connection()
+            row = conn.execute('SELECT value, accessed FROM entries WHERE key = ?',
+                               (key, )).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            if now - row[1] > ACCESS_UPDATE_INTERVAL:
+                conn.execute('UPDATE entries SET accessed = ? WHERE key = ?',
+                             (now, key))
+            return bytes(row[0])
+        except sqlite3.Error as e:
+            logger.warning(f"Conversion cache read failed: {e}")
+            return None
+
+    def get_many(self, keys):
+        """Return a dict of the cached bytes for those of `keys` that are present."""
+        found = {}
+        stale = []
+        try:
+            conn = self._connection()
+            keys = list(keys)
+            now = time.time()
+            # Stay under SQLite's limit on query parameters
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                placeholders = ','.join('?' * len(batch))
+                for key, value, accessed in conn.execute(
+                        f'SELECT key, value, accessed FROM entries WHERE key IN ({placeholders})',
+                        batch):
+                    found[key] = bytes(value)
+                    if now - accessed > ACCESS_UPDATE_INTERVAL:
+                        stale.append((now, key))
+            if stale:
+                conn.executemany('UPDATE entries SET accessed = ? WHERE key = ?',
+                                 stale)
+            return found
+        except sqlite3.Error as e:
+            logger.warning(f"Conversion cache read failed: {e}")
+            return {}
+
+    def put(self, key, value):
+        """Store `value` under `key`, evicting old entries past max_bytes."""
+        self.put_many({key: value})
+
+    def put_many(self, items):
+        """Store a dict of values in one transaction, evicting old entries past max_bytes."""
+        now = time.time()
+        rows = [(key, value, len(value), now) for key, value in items.items()
+                if len(value) <= self.max_bytes]
+        if not rows:
+            return
+        try:
+            conn = self._connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.executemany(
+                    'INSERT OR REPLACE INTO entries (key, value, size, accessed) VALUES (?, ?, ?, ?)',
+                    rows)
+                total = conn.execute(
+                    'SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+                if total > self.max_bytes:
+                    self._evict(conn, total - self.max_bytes)
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+        except sqlite3.Error as e:
+            logger.warning(f"Conversion cache write failed: {e}")
+
+    def _evict(self, conn, excess):
+        freed = 0
+        evicted = []
+        for key, size in conn.execute('SELECT key, size FROM entries ORDER BY accessed'):
+            evicted.append((key, ))
+            freed += size
+            if freed >= excess:
+                break
+        conn.executemany('DELETE FROM entries WHERE key = ?', evicted)
+
+    def get_json(self, key):
+        """Return the cached JSON value for `key`, or None."""
+        value = self.get(key)
+        return None if value is None else json.loads(value)
+
+    def get_many_json(self, keys):
+        return {key: json.loads(value) for key, value in self.get_many(keys).items()}
+
+    def put_json(self, key, value):
+        self.put(key, json.dumps(value, separators=(',', ':')).encode('utf-8'))
+
+    def put_many_json(self, items):
+        self.put_many({key: json.dumps(value, separators=(',', ':')).encode('utf-8')
+                       for key, value in items.items()})
@@ -0,0 +1,91 @@
+"""
+Gunicorn configuration for production.
+
+The app is loaded once in the master and warmed up (converter tables,
+schema validators, preview samples, prerendered pages) before any worker
+is forked. The garbage collector is disabled in the master and the heap is
+frozen right before each fork, so workers keep sharing those pages
+copy-on-write instead of each building and dirtying its own copy.
+
+Worker and thread counts are derived from the CPUs and memory available to
+the machine; WEB_CONCURRENCY and GUNICORN_THREADS override them.
+"""
+
+import gc
+import os
+
+# Objects allocated by the master must not be moved or touched by the
+# collector before forking; collection is re-enabled in each worker
+gc.disable()
+
+# Memory a worker adds on top of what it shares with the master, and memory
+# left for the master itself and the ensemble process pool
+WORKER_MEMORY_MB = int(os.environ.get('WORKER_MEMORY_MB', 160))
+RESERVED_MEMORY_MB = int(os.environ.get('RESERVED_MEMORY_MB', 320))
+
+
+def available_cpus():
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    # cgroup v2 CPU quota, as set by container runtimes
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+        if quota != 'max':
+            cpus = min(cpus, max(1, int(quota) // int(period)))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+
+def available_memory_mb():
+    limits = []
+    for path in ('/sys/fs/cgroup/memory.max',
+                 '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        try:
+            with open(path) as f:
+                limits.append(int(f.read().strip()) // (1024 * 1024))
+        except (OSError, ValueError):  # missing, or 'max'
+            pass
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemTotal:'):
+                    limits.append(int(line.split()[1]) // 1024)
+                    break
+    except OSError:
+        pass
+    return min(limits) if limits else 1024
+
+
+def default_workers():
+    by_cpu = 2 * available_cpus() + 1
+    by_memory = (available_memory_mb() - RESERVED_MEMORY_MB) // WORKER_MEMORY_MB
+    return max(1, min(by_cpu, by_memory))
+
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+preload_app = True
+workers = int(os.environ.get('WEB_CONCURRENCY', 0)) or default_workers()
+# Threads keep slow clients and event streams from blocking a whole worker;
+# CPU-heavy conversions are capped separately by admission control
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+
+
+def when_ready(server):
+    import main
+    main.warm_up()
+    server.log.info(f"Warmed up app; starting {workers} workers "
+                    f"with {threads} threads each")
+
+
+def pre_fork(server, worker):
+    # Move everything allocated so far out of the collector's reach
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    gc.enable()
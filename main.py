@@ -3,14 +3,27 @@ import os
 import io
 import tempfile
 import logging
+import hashlib
+import threading
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import math
+import multiprocessing
 import json
 import ugly_midi
 import jsonschema
 from jsonschema import validate
+import audio_preview
+from response_compression import init_compression
+from admission import AdmissionController, admission_controlled
+from conversion_cache import ConversionCache
+import soundfont_subset
+from urllib.parse import urlparse, parse_qsl
+from werkzeug.datastructures import MultiDict
 
 app = Flask(__name__)
+init_compression(app)
 
 # Define your preferred canonical domain
 CANONICAL_DOMAIN = "www.pianotour.com"
@@ -38,7 +51,17 @@ def midi_to_json_data(midi_file_path):
     try:
         # Use ugly_midi to convert MIDI to VexFlow JSON
         vexflow_json = ugly_midi.midi_to_json(midi_file_path)
+    except Exception as e:
+        logger.error(f"ugly_midi failed to parse MIDI file: {e}")
+        raise ValueError(f"Failed to convert MIDI file: {str(e)}")
+    return vexflow_to_song_data(vexflow_json)
+
 
+def vexflow_to_song_data(vexflow_json):
+    """
+    Transform ugly_midi's VexFlow JSON into the app's measures format.
+    """
+    try:
         # Transform VexFlow format to your app's expected format
         song_data = []
 
@@ -71,78 +94,136 @@ def midi_to_json_data(midi_file_path):
         return song_data
 
     except Exception as e:
-        logger.error(f"ugly_midi failed to parse MIDI file: {e}")
+        logger.error(f"Failed to transform converted MIDI data: {e}")
         raise ValueError(f"Failed to convert MIDI file: {str(e)}")
 
 
+# --- Admission control ---
+# Shared by all gunicorn workers through a local SQLite file, so one client
+# uploading a burst of files cannot saturate the CPU for everyone.
+admission_controller = AdmissionController()
+
+
+def _song_measure_count(song_data):
+    if not isinstance(song_data, dict):
+        return 0
+    if 'changedMeasures' in song_data and isinstance(song_data['changedMeasures'], dict):
+        return len(song_data['changedMeasures'])
+    measures = song_data.get('measures')
+    return len(measures) if isinstance(measures, list) else 0
+
+
+def estimate_song_cost(req):
+    """Token cost of a song upload: one per request, plus measures and bytes."""
+    cost = 1.0 + (req.content_length or 0) / (256 * 1024)
+    if req.is_json:
+        song_data = req.get_json(silent=True)
+        if isinstance(song_data, dict) and isinstance(song_data.get('parts'), list):
+            cost += sum(_song_measure_count(part) for part in song_data['parts']) / 100
+        else:
+            cost += _song_measure_count(song_data) / 100
+    return cost
+
+
+def estimate_midi_upload_cost(req):
+    """Token cost of a MIDI upload: one per request, plus one per 64 KB."""
+    return 1.0 + (req.content_length or 0) / (64 * 1024)
+
+
+def estimate_soundfont_subset_cost(req):
+    """Token cost of building a SoundFont subset: a few MB to read and write."""
+    return 2.0
+
+
+# --- Prerendered pages ---
+# Page templates only depend on the route and its fixed context, so each
+# page is rendered once and the HTML reused. warm_up() renders them all in
+# the gunicorn master so workers share the result.
+PAGE_PATHS = [
+    '/', '/editor', '/json', '/extras', '/print', '/practice', '/guitar',
+    '/cello', '/sax', '/drums', '/player', '/testplayer', '/integrated'
+]
+page_cache = {}
+
+
+def render_page(template_name, **context):
+    key = (request.path, template_name, tuple(sorted(context.items())))
+    html = page_cache.get(key)
+    if html is None:
+        html = render_template(template_name, **context)
+        if not app.debug:
+            page_cache[key] = html
+    return html
+
+
 # --- Flask Routes ---
 
 
 @app.route('/')
 def index():
-    return render_template('piano.html', hide_spectrum=False)
+    return render_page('piano.html', hide_spectrum=False)
 
 
 @app.route('/editor')
 def editor():
-    return render_template('editor.html', show_side_panel=True)
+    return render_page('editor.html', show_side_panel=True)
 
 
 @app.route('/json')
 def json():
-    return render_template('json.html', show_side_panel=True)
+    return render_page('json.html', show_side_panel=True)
 
 
 @app.route('/extras')
 def extras():
-    return render_template('extras.html', show_side_panel=True)
+    return render_page('extras.html', show_side_panel=True)
 
 
 @app.route('/print')
 def print_page():
-    return render_template('print.html')
+    return render_page('print.html')
 
 
 @app.route('/practice')
 def practice():
-    return render_template('practice.html')
+    return render_page('practice.html')
 
 
 @app.route('/guitar')
 def guitar():
     """Guitar instrument route"""
-    return render_template('guitar.html', instrument='guitar')
+    return render_page('guitar.html', instrument='guitar')
 
 
 @app.route('/cello')
 def cello():
     """Guitar instrument route"""
-    return render_template('cello.html', instrument='cello')
+    return render_page('cello.html', instrument='cello')
 
 
 @app.route('/sax')
 def sax():
     """Guitar instrument route"""
-    return render_template('sax.html', instrument='sax')
+    return render_page('sax.html', instrument='sax')
 
 @app.route('/drums')
 def drums():
     """Drums instrument route"""
-    return render_template('drums.html')
+    return render_page('drums.html')
 
 @app.route('/player')
 def player():
-    return render_template('player.html')
+    return render_page('player.html')
 
 
 @app.route('/testplayer')
 def testplayer():
-    return render_template('testplayer.html')
+    return render_page('testplayer.html')
 
 
 @app.route('/integrated')
 def integrated():
-    return render_template('spesIndex.html')
+    return render_page('spesIndex.html')
 
 
 # SpessaSynth expects these routes:
@@ -199,9 +280,104 @@ def save_settings():
     })
 
 
+DEFAULT_SOUNDFONT = os.path.join(app.static_folder, 'soundfonts', 'default.sf3')
+
+
+def soundfont_programs_from_args(args):
+    """
+    Get the (bank, program) pairs a song needs from query arguments.
+
+    Accepts ?instrument=piano,cello (mapped with ugly_midi.get_instrument_program)
+    and/or ?programs=0,24. Drums use the percussion bank.
+    """
+    wanted = set()
+    for name in ','.join(args.getlist('instrument')).split(','):
+        name = name.strip().lower()[:50]
+        if not name:
+            continue
+        if name == 'drums':
+            wanted.add((soundfont_subset.PERCUSSION_BANK, 0))
+        else:
+            wanted.add((0, ugly_midi.get_instrument_program(name)))
+    for program in ','.join(args.getlist('programs')).split(','):
+        program = program.strip()
+        if program.isdigit() and int(program) <= 127:
+            wanted.add((0, int(program)))
+    return wanted
+
+
+def soundfont_subset_name(wanted):
+    """Encode a program set as a subset file name, e.g. '0-24-d0'."""
+    return '-'.join(
+        f'd{program}' if bank == soundfont_subset.PERCUSSION_BANK else str(program)
+        for bank, program in sorted(wanted))
+
+
 @app.route('/soundfonts')
 def soundfont():
-    return jsonify([{'name': '/static/soundfonts/default.sf3'}])
+    """
+    List the SoundFonts for the integrated player.
+
+    If the song's instruments or programs are known (from the query string,
+    or from the query string of the page that asked), the first entry is a
+    subset with only those presets. The full bank is always listed, for
+    uploaded MIDI files that use other presets.
+    """
+    wanted = soundfont_programs_from_args(request.args)
+    if not wanted and request.referrer:
+        referrer_args = MultiDict(parse_qsl(urlparse(request.referrer).query))
+        wanted = soundfont_programs_from_args(referrer_args)
+
+    soundfonts = [{'name': '/static/soundfonts/default.sf3'}]
+    if wanted and os.path.exists(DEFAULT_SOUNDFONT):
+        soundfonts.insert(0, {'name': f'/soundfonts/subset/{soundfont_subset_name(wanted)}.sf3'})
+    return jsonify(soundfonts)
+
+
+@app.route('/soundfonts/subset/<programs>.sf3')
+def soundfont_subset_file(programs):
+    """
+    Serve a subset of the default SoundFont, e.g. /soundfonts/subset/0-24-d0.sf3
+
+    Cached subsets are plain static files; only building a new subset goes
+    through admission control.
+    """
+    wanted = set()
+    for token in programs.split('-')[:32]:
+        bank = 0
+        if token.startswith('d'):
+            bank, token = soundfont_subset.PERCUSSION_BANK, token[1:]
+        if not token.isdigit() or int(token) > 127:
+            return jsonify({'error': f'Invalid program: {token}'}), 400
+        wanted.add((bank, int(token)))
+
+    if not wanted:
+        return jsonify({'error': 'No programs requested'}), 400
+    if not os.path.exists(DEFAULT_SOUNDFONT):
+        return jsonify({'error': 'Not found'}), 404
+
+    subset_file = soundfont_subset.open_cached_subset(DEFAULT_SOUNDFONT, wanted)
+    if subset_file is None:
+        return build_soundfont_subset(programs, wanted)
+    return send_soundfont_subset(programs, subset_file)
+
+
+@admission_controlled(admission_controller, estimate_soundfont_subset_cost)
+def build_soundfont_subset(programs, wanted):
+    try:
+        subset_file = soundfont_subset.open_subset(DEFAULT_SOUNDFONT, wanted)
+    except (ValueError, OSError) as e:
+        logger.error(f"SoundFont subsetting failed: {e}")
+        return jsonify({'error': 'Failed to build SoundFont subset'}), 500
+    return send_soundfont_subset(programs, subset_file)
+
+
+def send_soundfont_subset(programs, subset_file):
+    return send_file(subset_file,
+                     mimetype='application/octet-stream',
+                     download_name=f'{programs}.sf3',
+                     etag=os.path.basename(subset_file.name),
+                     max_age=86400)
 
 
 @app.route('/setlastsf2')
@@ -320,6 +496,32 @@ SONG_DATA_SCHEMA = {
 }
 
 
+def sanitize_measure(measure):
+    """
+    Sanitize the notes of a single measure
+    """
+    sanitized_measure = []
+    for note_idx, note in enumerate(measure[:100]):  # Limit notes per measure
+        if not isinstance(note, dict):
+            continue
+
+        # Basic sanitization - remove null bytes, limit string lengths
+        sanitized_note = {}
+        for key, value in note.items():
+            if isinstance(value, str):
+                # Remove null bytes and limit length
+                clean_value = value.replace('\x00', '').strip()
+                sanitized_note[key] = clean_value[:100]  # Reasonable limit
+            elif isinstance(value, (int, float, bool)):
+                sanitized_note[key] = value
+            elif value is None:
+                sanitized_note[key] = None
+            # Ignore complex objects/arrays to prevent injection
+
+        sanitized_measure.append(sanitized_note)
+    return sanitized_measure
+
+
 def sanitize_for_ugly_midi(song_data):
     """
     Sanitize full object structure with metadata + measures
@@ -339,27 +541,7 @@ def sanitize_for_ugly_midi(song_data):
     for measure_idx, measure in enumerate(measures[:1000]):  # Limit measures
         if not isinstance(measure, list):
             continue
-
-        sanitized_measure = []
-        for note_idx, note in enumerate(measure[:100]):  # Limit notes per measure
-            if not isinstance(note, dict):
-                continue
-
-            # Basic sanitization - remove null bytes, limit string lengths
-            sanitized_note = {}
-            for key, value in note.items():
-                if isinstance(value, str):
-                    # Remove null bytes and limit length
-                    clean_value = value.replace('\x00', '').strip()
-                    sanitized_note[key] = clean_value[:100]  # Reasonable limit
-                elif isinstance(value, (int, float, bool)):
-                    sanitized_note[key] = value
-                elif value is None:
-                    sanitized_note[key] = None
-                # Ignore complex objects/arrays to prevent injection
-
-            sanitized_measure.append(sanitized_note)
-        sanitized_measures.append(sanitized_measure)
+        sanitized_measures.append(sanitize_measure(measure))
 
     # Create the sanitized object with metadata preserved
     sanitized_data = {
@@ -376,17 +558,221 @@ def sanitize_for_ugly_midi(song_data):
     return sanitized_data
 
 
-@app.route('/convert-to-midi', methods=['POST'])
-def convert_to_midi():
-    temp_midi_path = None
-    try:
-        # Check content type
-        if not request.is_json:
-            return jsonify({'error': 'Content-Type must be application/json'}), 400
+# --- Incremental conversion ---
+# An export is identified by a version ID, a hash of the song metadata and
+# of the content key of each measure. Versions and per-measure events live
+# in the shared conversion cache, so a client can send only the measures
+# that changed since a version exported by any worker. Only those measures
+# are validated, sanitized and converted; the events of the others are
+# reused and written straight to MIDI bytes.
+MEASURE_EVENT_CACHE = ugly_midi.MeasureEventCache(max_entries=20000)
+# Finished conversions, shared on disk by all workers and kept across restarts
+CONVERSION_CACHE = ConversionCache()
+
+# Fields of a delta request that are not song metadata
+SCORE_DELTA_FIELDS = ('baseVersion', 'measureCount', 'changedMeasures')
+
+
+def song_metadata(sanitized_data):
+    return {k: v for k, v in sanitized_data.items() if k != 'measures'}
+
+
+def score_version_id(metadata, measure_keys):
+    """
+    Compute a version ID for a sanitized song from its metadata and measure keys.
+    """
+    digest = hashlib.sha1()
+    digest.update(repr(sorted(metadata.items())).encode('utf-8'))
+    for measure_key in measure_keys:
+        digest.update(measure_key.encode('ascii'))
+    return digest.hexdigest()[:16]
+
+
+def score_version_key(version_id):
+    return CONVERSION_CACHE.make_key('score-version', version_id.encode('ascii'))
+
+
+def measure_events_key(measure_key):
+    return CONVERSION_CACHE.make_key('measure-events', measure_key.encode('ascii'))
+
+
+def convert_measure(measure):
+    """
+    Return the content key and events of a sanitized measure.
+    """
+    measure_key = ugly_midi.measure_cache_key(measure)
+    events = MEASURE_EVENT_CACHE.get(measure_key)
+    if events is None:
+        events = ugly_midi.get_measure_events(measure)
+        MEASURE_EVENT_CACHE.put(measure_key, events)
+    return measure_key, events
+
+
+def score_from_song(sanitized_data):
+    """
+    Split a sanitized song into its metadata, measure keys and measure events.
+
+    Returns:
+        tuple: (metadata, measure_keys, events_by_key)
+    """
+    measure_keys = []
+    events_by_key = {}
+    for measure in sanitized_data['measures']:
+        measure_key, events = convert_measure(measure)
+        measure_keys.append(measure_key)
+        events_by_key[measure_key] = events
+    return song_metadata(sanitized_data), measure_keys, events_by_key
+
+
+def save_score_version(version_id, metadata, measure_keys, events_by_key):
+    """
+    Store a score version and the events of its new measures in the shared cache.
+    """
+    items = {
+        measure_events_key(measure_key): events
+        for measure_key, events in events_by_key.items()
+    }
+    items[score_version_key(version_id)] = {
+        'metadata': metadata,
+        'measureKeys': measure_keys
+    }
+    CONVERSION_CACHE.put_many_json(items)
+
+
+def load_measure_events(measure_keys):
+    """
+    Look up the events of each measure, in this process or in the shared cache.
+
+    Returns:
+        list: Events of each measure, or None if any of them has expired
+    """
+    measure_events = [MEASURE_EVENT_CACHE.get(key) for key in measure_keys]
+    missing = {key for key, events in zip(measure_keys, measure_events)
+               if events is None}
+    if missing:
+        stored = CONVERSION_CACHE.get_many_json(
+            measure_events_key(key) for key in missing)
+        for measure_idx, measure_key in enumerate(measure_keys):
+            if measure_events[measure_idx] is not None:
+                continue
+            events = stored.get(measure_events_key(measure_key))
+            if events is None:
+                return None
+            measure_events[measure_idx] = tuple(map(tuple, events))
+            MEASURE_EVENT_CACHE.put(measure_key, measure_events[measure_idx])
+    return measure_events
+
+
+def apply_score_delta(delta):
+    """
+    Apply a delta request to a stored score version.
+
+    A delta has the form:
+        {
+            "baseVersion": "<version ID from X-Score-Version>",
+            "measureCount": 12,
+            "changedMeasures": {"3": [...notes...], "11": [...]},
+            ...optional metadata fields (tempo, keySignature, ...)
+        }
+
+    The stored version is already validated and sanitized, so only the
+    changed measures and metadata are.
+
+    Returns:
+        tuple: (metadata, measure_keys, events_by_key), or None if the base
+            version is not in the shared cache
+
+    Raises:
+        ValueError: If the delta is malformed
+        jsonschema.exceptions.ValidationError: If a changed measure or the
+            metadata is invalid
+    """
+    base = CONVERSION_CACHE.get_json(score_version_key(str(delta.get('baseVersion'))))
+    if base is None:
+        return None
+
+    changed = delta.get('changedMeasures') or {}
+    if not isinstance(changed, dict):
+        raise ValueError("changedMeasures must be an object keyed by measure index")
+
+    measure_keys = base['measureKeys']
+    measure_count = delta.get('measureCount', len(measure_keys))
+    if not isinstance(measure_count, int) or not 0 <= measure_count <= 1000:
+        raise ValueError("measureCount must be an integer between 0 and 1000")
+
+    metadata = base['metadata']
+    overrides = {k: v for k, v in delta.items() if k not in SCORE_DELTA_FIELDS}
+    if overrides:
+        song_data = dict(metadata, **overrides, measures=[])
+        validate(instance=song_data, schema=SONG_HEADER_SCHEMA)
+        metadata = song_metadata(sanitize_for_ugly_midi(song_data))
+
+    events_by_key = {}
+    measure_keys = measure_keys[:measure_count]
+    if len(measure_keys) < measure_count:
+        empty_key, events_by_key[empty_key] = convert_measure([])
+        measure_keys.extend([empty_key] * (measure_count - len(measure_keys)))
+    for index, measure in changed.items():
+        try:
+            measure_idx = int(index)
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid measure index: {index!r}")
+        if not 0 <= measure_idx < measure_count:
+            raise ValueError(f"Measure index out of range: {measure_idx}")
+        MEASURE_VALIDATOR.validate(measure)
+        measure_key, events = convert_measure(sanitize_measure(measure))
+        measure_keys[measure_idx] = measure_key
+        events_by_key[measure_key] = events
+
+    return metadata, measure_keys, events_by_key
+
+
+# Defaults for metadata that a binary score leaves out, matching sanitize_for_ugly_midi
+BINARY_SONG_DEFAULTS = {
+    "keySignature": "C",
+    "tempo": 120.0,
+    "timeSignature": {"numerator": 4, "denominator": 4},
+    "instrument": "piano",
+    "midiChannel": 0,
+    "isMinorChordMode": False
+}
+MAX_BINARY_SONG_BYTES = 256 * 1024
 
+
+def decode_binary_song(data):
+    """
+    Decode an ugly_midi binary score upload into the sanitized song structure.
+    """
+    song_data = ugly_midi.decode_score(data)
+    for key, value in BINARY_SONG_DEFAULTS.items():
+        song_data.setdefault(key, dict(value) if isinstance(value, dict) else value)
+    return song_data
+
+
+def load_song_from_request():
+    """
+    Read a song from a JSON or binary score request body.
+
+    Returns:
+        tuple: (sanitized_data, None) on success, or (None, error_response)
+    """
+    # Check content type
+    if request.mimetype == ugly_midi.SCORE_CONTENT_TYPE:
+        # Binary scores are bounds-checked while decoding, so they skip
+        # the JSON size check, schema validation and sanitization
+        if (request.content_length or 0) > MAX_BINARY_SONG_BYTES:
+            return None, (jsonify({'error': 'Song data too large'}), 413)
+        try:
+            sanitized_data = decode_binary_song(request.get_data())
+        except ValueError as e:
+            logger.error(f"Binary score decoding failed: {str(e)}")
+            return None, (jsonify({'error': str(e)}), 400)
+    elif not request.is_json:
+        return None, (jsonify({'error': f'Content-Type must be application/json or {ugly_midi.SCORE_CONTENT_TYPE}'}), 400)
+    else:
         song_data = request.get_json()
         if not song_data:
-            return jsonify({'error': 'No song data provided'}), 400
+            return None, (jsonify({'error': 'No song data provided'}), 400)
 
         # Add debug logging
         logger.info(f"Received object with keys: {list(song_data.keys()) if isinstance(song_data, dict) else 'Not a dict'}")
@@ -395,27 +781,252 @@ def convert_to_midi():
 
         # Check size limits
         if len(str(song_data)) > 1024 * 1024:  # 1MB limit
-            return jsonify({'error': 'Song data too large'}), 413
+            return None, (jsonify({'error': 'Song data too large'}), 413)
 
         # Validate against schema
         try:
             validate(instance=song_data, schema=SONG_DATA_SCHEMA)
         except jsonschema.exceptions.ValidationError as e:
             logger.error(f"Schema validation failed: {str(e)}")
-            return jsonify({'error': f'Invalid song data format: {str(e)}'}), 400
+            return None, (jsonify({'error': f'Invalid song data format: {str(e)}'}), 400)
 
         # Sanitize input
         try:
             sanitized_data = sanitize_for_ugly_midi(song_data)
+        except ValueError as e:
+            logger.error(f"Sanitization failed: {str(e)}")
+            return None, (jsonify({'error': str(e)}), 400)
+
+    return sanitized_data, None
+
+
+@app.route('/convert-to-midi', methods=['POST'])
+@admission_controlled(admission_controller, estimate_song_cost)
+def convert_to_midi():
+    try:
+        song_data = request.get_json(silent=True) if request.is_json else None
+        if isinstance(song_data, dict) and 'baseVersion' in song_data:
+            # Delta requests only carry the measures that changed since baseVersion
+            try:
+                score = apply_score_delta(song_data)
+            except jsonschema.exceptions.ValidationError as e:
+                logger.error(f"Schema validation failed: {str(e)}")
+                return jsonify({'error': f'Invalid song data format: {e.message}'}), 400
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+        else:
+            sanitized_data, error = load_song_from_request()
+            if error:
+                return error
+            score = score_from_song(sanitized_data)
+
+        if score is None:
+            # Unknown version (expired from the shared cache): the client
+            # should resend the full song
+            return jsonify({'error': 'Unknown base version'}), 409
+        metadata, measure_keys, events_by_key = score
+
+        version_id = score_version_id(metadata, measure_keys)
+        cache_key = CONVERSION_CACHE.make_key('json-to-midi',
+                                              version_id.encode('ascii'))
+        midi_bytes = CONVERSION_CACHE.get(cache_key)
+        if midi_bytes is None:
+            measure_events = load_measure_events(measure_keys)
+            if measure_events is None:
+                return jsonify({'error': 'Unknown base version'}), 409
+            midi_bytes = ugly_midi.encode_midi(metadata, measure_events)
+            CONVERSION_CACHE.put(cache_key, midi_bytes)
+        save_score_version(version_id, metadata, measure_keys, events_by_key)
+
+        response = send_file(io.BytesIO(midi_bytes),
+                             as_attachment=True,
+                             download_name='score.mid',
+                             mimetype='audio/midi')
+        response.headers['X-Score-Version'] = version_id
+        return response
+
+    except Exception as e:
+        logger.error(f"Error during MIDI conversion: {e}", exc_info=True)
+        return jsonify({'error': 'Failed to convert to MIDI'}), 500
+
+
+# --- Progressive playback ---
+# Songs are streamed as Server-Sent Events, converted one measure at a time,
+# so the player can start the first bars before the whole song is converted.
+# JSON songs are only validated up front for their metadata; each measure is
+# validated and sanitized just before it is converted, so the time to the
+# first note does not grow with the length of the song.
+SONG_HEADER_SCHEMA = dict(SONG_DATA_SCHEMA,
+                          properties=dict(SONG_DATA_SCHEMA['properties'],
+                                          measures={
+                                              "type": "array",
+                                              "maxItems": 1000
+                                          }))
+MEASURE_VALIDATOR = jsonschema.validators.validator_for(SONG_DATA_SCHEMA)(
+    SONG_DATA_SCHEMA['properties']['measures']['items'])
+
+
+def validated_measures(measures):
+    for measure in measures:
+        MEASURE_VALIDATOR.validate(measure)
+        yield sanitize_measure(measure)
+
+
+@app.route('/stream-midi-events', methods=['POST'])
+@admission_controlled(admission_controller, estimate_song_cost)
+def stream_midi_events():
+    if request.mimetype == ugly_midi.SCORE_CONTENT_TYPE:
+        sanitized_data, error = load_song_from_request()
+        if error:
+            return error
+    elif not request.is_json:
+        return jsonify({'error': f'Content-Type must be application/json or {ugly_midi.SCORE_CONTENT_TYPE}'}), 400
+    else:
+        song_data = request.get_json()
+        if not song_data:
+            return jsonify({'error': 'No song data provided'}), 400
+        try:
+            validate(instance=song_data, schema=SONG_HEADER_SCHEMA)
+        except jsonschema.exceptions.ValidationError as e:
+            logger.error(f"Schema validation failed: {str(e)}")
+            return jsonify({'error': f'Invalid song data format: {str(e)}'}), 400
+        try:
+            sanitized_data = sanitize_for_ugly_midi(dict(song_data, measures=[]))
         except ValueError as e:
             logger.error(f"Sanitization failed: {str(e)}")
             return jsonify({'error': str(e)}), 400
+        sanitized_data['measures'] = validated_measures(song_data['measures'])
+
+    events = ugly_midi.stream_midi_events(sanitized_data,
+                                          measure_cache=MEASURE_EVENT_CACHE)
+
+    def sse(event_type, data):
+        return f"event: {event_type}\ndata: {app.json.dumps(data)}\n\n"
 
-        # Process with ugly_midi - you may need to pass just the measures or the full object
-        # depending on what your ugly_midi library expects
-        midi_data = ugly_midi.json_to_midi(sanitized_data)
+    def generate():
+        try:
+            for event in events:
+                yield sse(event['type'], event)
+        except jsonschema.exceptions.ValidationError as e:
+            logger.error(f"Schema validation failed: {str(e)}")
+            yield sse('error', {'error': f'Invalid song data format: {e.message}'})
+        except Exception as e:
+            logger.error(f"Error during MIDI event streaming: {e}", exc_info=True)
+            yield sse('error', {'error': 'Failed to convert to MIDI'})
+
+    response = app.response_class(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Stop proxies from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+# --- Ensemble export ---
+# Part instruments are built in parallel worker processes when there is more
+# than one CPU; with a single CPU the pool would only add pickling overhead.
+# The pool is created lazily with forkserver, since forking a multi-threaded
+# gunicorn worker can deadlock, and replaced if one of its processes dies.
+# Writing the MIDI file stays serial.
+ENSEMBLE_MAX_PARTS = 16  # One part per MIDI channel
+
+
+def available_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # Not available on macOS and Windows
+        return os.cpu_count() or 1
+
+
+ENSEMBLE_WORKERS = int(os.environ.get('ENSEMBLE_WORKERS', min(4, available_cpus())))
+ensemble_executor = None
+ensemble_executor_lock = threading.Lock()
+
+
+def get_ensemble_executor():
+    """Return the shared process pool, or None if parts should be built serially."""
+    global ensemble_executor
+    if ENSEMBLE_WORKERS <= 1:
+        return None
+    with ensemble_executor_lock:
+        if ensemble_executor is None:
+            # forkserver is not available on Windows
+            start_method = ('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods()
+                            else 'spawn')
+            ensemble_executor = ProcessPoolExecutor(
+                max_workers=ENSEMBLE_WORKERS,
+                mp_context=multiprocessing.get_context(start_method))
+        return ensemble_executor
+
+
+def discard_ensemble_executor(executor):
+    """Drop a broken process pool so the next request creates a new one."""
+    global ensemble_executor
+    with ensemble_executor_lock:
+        if ensemble_executor is executor:
+            ensemble_executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+@app.route('/convert-ensemble-to-midi', methods=['POST'])
+@admission_controlled(admission_controller, estimate_song_cost)
+def convert_ensemble_to_midi():
+    """
+    Convert several parts into one multi-instrument MIDI file.
+
+    Expects {"parts": [song, song, ...], "tempo": optional override}, where
+    each song has the same format as the /convert-to-midi payload.
+    """
+    temp_midi_path = None
+    try:
+        if not request.is_json:
+            return jsonify({'error': 'Content-Type must be application/json'}), 400
+
+        ensemble_data = request.get_json()
+        if not isinstance(ensemble_data, dict) or not isinstance(ensemble_data.get('parts'), list):
+            return jsonify({'error': "Ensemble data must contain a 'parts' array"}), 400
+
+        parts = ensemble_data['parts']
+        if not parts:
+            return jsonify({'error': 'No parts provided'}), 400
+        if len(parts) > ENSEMBLE_MAX_PARTS:
+            return jsonify({'error': f'Too many parts (maximum {ENSEMBLE_MAX_PARTS})'}), 400
+
+        # Check size limits
+        if len(str(parts)) > 4 * 1024 * 1024:  # 4MB limit for all parts
+            return jsonify({'error': 'Ensemble data too large'}), 413
+
+        tempo_override = ensemble_data.get('tempo')
+        if tempo_override is not None:
+            if not isinstance(tempo_override, (int, float)) or isinstance(tempo_override, bool):
+                return jsonify({'error': 'Tempo must be a number'}), 400
+            tempo_override = max(20, min(300, float(tempo_override)))
+
+        sanitized_parts = []
+        for part_idx, part in enumerate(parts):
+            try:
+                validate(instance=part, schema=SONG_DATA_SCHEMA)
+                sanitized_parts.append(sanitize_for_ugly_midi(part))
+            except jsonschema.exceptions.ValidationError as e:
+                logger.error(f"Schema validation failed for part {part_idx}: {str(e)}")
+                return jsonify({'error': f'Invalid data for part {part_idx}: {e.message}'}), 400
+            except ValueError as e:
+                logger.error(f"Sanitization failed for part {part_idx}: {str(e)}")
+                return jsonify({'error': f'Part {part_idx}: {str(e)}'}), 400
+
+        logger.info(f"Converting ensemble with {len(sanitized_parts)} parts")
+
+        executor = get_ensemble_executor() if len(sanitized_parts) > 1 else None
+        try:
+            midi_data = ugly_midi.create_ensemble(sanitized_parts,
+                                                  tempo_override,
+                                                  executor=executor)
+        except BrokenProcessPool as e:
+            # A pool process died (e.g. killed for memory): build this
+            # ensemble serially and start a new pool for the next one
+            logger.error(f"Ensemble process pool broke: {e}")
+            discard_ensemble_executor(executor)
+            midi_data = ugly_midi.create_ensemble(sanitized_parts, tempo_override)
 
-        # Create secure temporary file
         fd, temp_midi_path = tempfile.mkstemp(suffix='.mid', prefix='midi_')
         os.close(fd)
 
@@ -423,12 +1034,12 @@ def convert_to_midi():
 
         return send_file(temp_midi_path,
                          as_attachment=True,
-                         download_name='score.mid',
+                         download_name='ensemble.mid',
                          mimetype='audio/midi')
 
     except Exception as e:
-        logger.error(f"Error during MIDI conversion: {e}", exc_info=True)
-        return jsonify({'error': 'Failed to convert to MIDI'}), 500
+        logger.error(f"Error during ensemble MIDI conversion: {e}", exc_info=True)
+        return jsonify({'error': 'Failed to convert ensemble to MIDI'}), 500
 
     finally:
         if temp_midi_path and os.path.exists(temp_midi_path):
@@ -438,7 +1049,77 @@ def convert_to_midi():
                 pass
 
 
+# --- Server-side audio preview ---
+# Rendered previews are kept in the shared conversion cache, keyed by song
+# version and renderer version, so a repeat preview is free on any worker.
+
+
+@app.route('/render-preview', methods=['POST'])
+@admission_controlled(admission_controller, estimate_song_cost)
+def render_preview():
+    """
+    Render a song to a short WAV preview using the static/samples library.
+
+    For clients that cannot run the in-browser synth. Accepts the same
+    payload as /convert-to-midi; the preview is limited to the first
+    audio_preview.MAX_PREVIEW_SECONDS seconds. Previews are 8-bit mu-law
+    WAV by default; pass ?encoding=pcm for 16-bit PCM at twice the size.
+    """
+    try:
+        encoding = request.args.get('encoding', audio_preview.DEFAULT_WAV_ENCODING)
+        if encoding not in audio_preview.WAV_ENCODINGS:
+            return jsonify({'error': f'Unsupported encoding: {encoding}'}), 400
+
+        if not request.is_json:
+            return jsonify({'error': 'Content-Type must be application/json'}), 400
+
+        song_data = request.get_json()
+        if not song_data:
+            return jsonify({'error': 'No song data provided'}), 400
+
+        if len(str(song_data)) > 1024 * 1024:  # 1MB limit
+            return jsonify({'error': 'Song data too large'}), 413
+
+        try:
+            validate(instance=song_data, schema=SONG_DATA_SCHEMA)
+        except jsonschema.exceptions.ValidationError as e:
+            logger.error(f"Schema validation failed: {str(e)}")
+            return jsonify({'error': f'Invalid song data format: {e.message}'}), 400
+
+        try:
+            sanitized_data = sanitize_for_ugly_midi(song_data)
+        except ValueError as e:
+            logger.error(f"Sanitization failed: {str(e)}")
+            return jsonify({'error': str(e)}), 400
+
+        if not audio_preview.supports_instrument(sanitized_data['instrument']):
+            return jsonify({'error': f"No audio preview for instrument '{sanitized_data['instrument']}'"}), 400
+
+        measure_keys = [ugly_midi.measure_cache_key(m) for m in sanitized_data['measures']]
+        version_id = score_version_id(song_metadata(sanitized_data), measure_keys)
+        preview_key = CONVERSION_CACHE.make_key(
+            'preview',
+            f'{audio_preview.renderer_version()}-{version_id}-{encoding}'.encode('ascii'))
+        wav_data = CONVERSION_CACHE.get(preview_key)
+        if wav_data is None:
+            audio = audio_preview.render_preview(sanitized_data)
+            wav_data = audio_preview.encode_wav(audio, encoding)
+            CONVERSION_CACHE.put(preview_key, wav_data)
+        else:
+            logger.info(f"Serving cached preview {preview_key[:16]}")
+
+        return send_file(io.BytesIO(wav_data),
+                         download_name='preview.wav',
+                         mimetype='audio/wav',
+                         etag=preview_key[:32])
+
+    except Exception as e:
+        logger.error(f"Error during preview rendering: {e}", exc_info=True)
+        return jsonify({'error': 'Failed to render preview'}), 500
+
+
 @app.route('/convert-to-json', methods=['POST'])
+@admission_controlled(admission_controller, estimate_midi_upload_cost)
 def convert_to_json():
     if 'midiFile' not in request.files:
         return jsonify({'error': 'No MIDI file provided.'}), 400
@@ -447,11 +1128,31 @@ def convert_to_json():
         return jsonify({'error': 'No file selected.'}), 400
     temp_midi_path = None
     try:
-        fd, temp_midi_path = tempfile.mkstemp(suffix='.mid')
-        os.close(fd)
-        file.save(temp_midi_path)
-        json_data = midi_to_json_data(temp_midi_path)
-        return jsonify(json_data)
+        midi_bytes = file.read()
+        # Only ugly_midi's output is cached (the cache key covers its code);
+        # the app's own transform runs on every request
+        cache_key = CONVERSION_CACHE.make_key('midi-to-vexflow', midi_bytes)
+        vexflow_json = CONVERSION_CACHE.get_json(cache_key)
+        if vexflow_json is None:
+            fd, temp_midi_path = tempfile.mkstemp(suffix='.mid')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(midi_bytes)
+            vexflow_json = ugly_midi.midi_to_json(temp_midi_path)
+            CONVERSION_CACHE.put_json(cache_key, vexflow_json)
+        json_data = vexflow_to_song_data(vexflow_json)
+
+        # Clients may ask for the compact binary score format instead of JSON
+        best = request.accept_mimetypes.best_match(
+            ['application/json', ugly_midi.SCORE_CONTENT_TYPE],
+            default='application/json')
+        if best == ugly_midi.SCORE_CONTENT_TYPE:
+            response = app.response_class(
+                ugly_midi.encode_score({'measures': json_data}),
+                mimetype=ugly_midi.SCORE_CONTENT_TYPE)
+        else:
+            response = jsonify(json_data)
+        response.vary.add('Accept')
+        return response
     except Exception as e:
         logger.error(f"Error during JSON conversion: {e}", exc_info=True)
         return jsonify({'error':
@@ -465,6 +1166,49 @@ def convert_to_json():
                     f"Failed to clean up temp file: {cleanup_error}")
 
 
+def warm_up():
+    """
+    Build lazily created state ahead of the first request.
+
+    Called by the gunicorn master before it forks workers (see
+    gunicorn.conf.py), so the converter tables, schema validators, preview
+    samples and prerendered pages are shared by all workers instead of being
+    built again in each one.
+    """
+    sample_song = {
+        'tempo': 120,
+        'measures': [[
+            {'id': '0-000', 'name': 'C4', 'clef': 'treble', 'duration': 'q'},
+            {'id': '0-001', 'name': 'E4', 'clef': 'treble', 'duration': '8'},
+            {'id': '0-002', 'name': 'B4', 'clef': 'treble', 'duration': '8', 'isRest': True},
+            {'id': '0-003', 'name': '(C3 E3 G3)', 'clef': 'bass', 'duration': 'h'},
+        ]]
+    }
+    validate(instance=sample_song, schema=SONG_DATA_SCHEMA)
+    validate(instance=sample_song, schema=SONG_HEADER_SCHEMA)
+    MEASURE_VALIDATOR.validate(sample_song['measures'][0])
+    sanitized_data = sanitize_for_ugly_midi(sample_song)
+    list(ugly_midi.stream_midi_events(sanitized_data))
+
+    # Round trip through both converters
+    fd, temp_midi_path = tempfile.mkstemp(suffix='.mid')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(ugly_midi.json_to_midi_bytes(sanitized_data))
+        midi_to_json_data(temp_midi_path)
+    finally:
+        os.unlink(temp_midi_path)
+
+    for instrument in audio_preview.INSTRUMENT_SAMPLES.values():
+        for file_name in instrument['samples'].values():
+            audio_preview.load_sample(file_name)
+    audio_preview.renderer_version()
+
+    client = app.test_client()
+    for path in PAGE_PATHS:
+        client.get(path, base_url=f'https://{CANONICAL_DOMAIN}')
+
+
 @app.route('/health')
 def health_check():
     return jsonify({'status': 'ok'})
\ No newline at end of file
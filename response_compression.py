@@ -0,0 +1,155 @@
+"""
+Accept-Encoding negotiated compression for API responses.
+
+Registers an after_request hook that compresses JSON, MIDI and binary score
+responses with brotli (if the optional Brotli package is installed) or gzip.
+Streamed responses are compressed chunk by chunk and flushed after every
+chunk, so clients still receive data as it is produced.
+
+Levels are tuned for a single shared vCPU: gzip 5 and brotli 4 keep most of
+the size reduction of the maximum levels at a fraction of the CPU time. Run
+`python response_compression.py song.json` to compare levels on a payload.
+"""
+
+import gzip
+import os
+import time
+import zlib
+
+try:
+    import brotli
+except ImportError:  # Brotli is optional; gzip is always available
+    brotli = None
+
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', 5))
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', 4))
+
+# Smaller bodies are sent as-is: compression overhead outweighs the savings
+MIN_COMPRESS_SIZE = int(os.environ.get('MIN_COMPRESS_SIZE', 1024))
+
+COMPRESSIBLE_MIMETYPES = {
+    'application/json',
+    'audio/midi',
+    'text/event-stream',
+    'application/vnd.ugly-midi.score',
+}
+
+
+def choose_encoding(accept_encodings):
+    """Pick 'br', 'gzip' or None from a werkzeug Accept-Encoding header."""
+    if brotli is not None and accept_encodings.quality('br') > 0:
+        return 'br'
+    if accept_encodings.quality('gzip') > 0:
+        return 'gzip'
+    return None
+
+
+def compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def _compress_stream(chunks, encoding):
+    """Compress an iterable of chunks, flushing after each one."""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            data = compressor.process(chunk) + compressor.flush()
+            if data:
+                yield data
+        yield compressor.finish()
+    else:
+        # wbits=31 produces a gzip container
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        yield compressor.flush()
+
+
+def compress_response(response, accept_encodings):
+    """
+    Compress a Flask response in place if the client and content allow it.
+    """
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+
+    # Caches must key compressed and uncompressed variants separately
+    response.vary.add('Accept-Encoding')
+
+    if (response.status_code < 200 or response.status_code in (204, 206, 304)
+            or 'Content-Encoding' in response.headers):
+        return response
+
+    encoding = choose_encoding(accept_encodings)
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = _compress_stream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        # send_file responses pass the file through; read it to compress
+        response.direct_passthrough = False
+        data = response.get_data()
+        if len(data) < MIN_COMPRESS_SIZE:
+            return response
+        response.set_data(compress(data, encoding))
+
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def init_compression(app):
+    """Register response compression on a Flask app."""
+    from flask import request
+
+    @app.after_request
+    def _compress_after_request(response):
+        return compress_response(response, request.accept_encodings)
+
+    return app
+
+
+def _benchmark(path, repeat=20):
+    """Print size and CPU time for each gzip level and brotli quality."""
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    def measure(label, func):
+        started = time.process_time()
+        for _ in range(repeat):
+            compressed = func()
+        elapsed = (time.process_time() - started) / repeat
+        ratio = len(compressed) / len(data)
+        print(f"{label:<12} {len(compressed):>10} {ratio:>7.1%} "
+              f"{elapsed * 1000:>9.2f} {len(data) / elapsed / 1e6:>9.1f}")
+
+    print(f"{path}: {len(data)} bytes")
+    print(f"{'encoding':<12} {'bytes':>10} {'ratio':>7} {'cpu ms':>9} {'MB/s':>9}")
+    for level in (1, 3, 5, 6, 9):
+        measure(f"gzip-{level}",
+                lambda: gzip.compress(data, compresslevel=level, mtime=0))
+    if brotli is not None:
+        for quality in (1, 3, 4, 5, 6, 9, 11):
+            measure(f"br-{quality}",
+                    lambda: brotli.compress(data, quality=quality))
+    else:
+        print("(install Brotli to include brotli in the comparison)")
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) != 2:
+        print("Usage: python response_compression.py <file>")
+        sys.exit(1)
+    _benchmark(sys.argv[1])
@@ -0,0 +1,431 @@
+"""
+SoundFont (SF2/SF3) subsetting for faster SpessaSynth startup.
+
+Reads the RIFF structure of a SoundFont through a memory map and writes a
+new SoundFont that only contains the presets for the requested
+(bank, program) pairs, along with the instruments and samples they use.
+SF3 files (Ogg Vorbis compressed samples) are copied without re-encoding.
+Subsets are cached on disk, keyed by the source file and the program set.
+The cache directory is bounded in size; the least recently used subsets
+are deleted first.
+"""
+
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+
+SOUNDFONT_CACHE_DIR = os.environ.get(
+    'SOUNDFONT_CACHE_DIR',
+    os.path.join(tempfile.gettempdir(), 'pianotour_soundfonts'))
+SOUNDFONT_CACHE_MAX_BYTES = int(
+    os.environ.get('SOUNDFONT_CACHE_MAX_BYTES', 200 * 1024 * 1024))
+
+PERCUSSION_BANK = 128
+
+# Generators that reference other records
+GEN_INSTRUMENT = 41
+GEN_SAMPLE_ID = 53
+
+# SF3 sample type flag for Ogg Vorbis compressed data
+SAMPLE_COMPRESSED = 0x10
+# Sample types that reference a linked (stereo) sample
+LINKED_SAMPLE_TYPES = (2, 4, 8)
+# Zero sample points required after each SF2 sample
+SAMPLE_PADDING = 46
+
+_CHUNK_HEADER = struct.Struct('<4sI')
+_PHDR = struct.Struct('<20sHHHIII')
+_BAG = struct.Struct('<HH')
+_MOD_SIZE = 10
+_GEN = struct.Struct('<HH')
+_INST = struct.Struct('<20sH')
+_SHDR = struct.Struct('<20sIIIIIBbHH')
+
+_PDTA_ORDER = ('phdr', 'pbag', 'pmod', 'pgen', 'inst', 'ibag', 'imod', 'igen', 'shdr')
+
+
+def _iter_chunks(data, start, end):
+    """Yield (id, data_start, size) for the RIFF chunks in data[start:end]."""
+    offset = start
+    while offset + _CHUNK_HEADER.size <= end:
+        chunk_id, size = _CHUNK_HEADER.unpack_from(data, offset)
+        data_start = offset + _CHUNK_HEADER.size
+        if data_start + size > end:
+            raise ValueError(f"Truncated SoundFont chunk {chunk_id!r}")
+        yield chunk_id.decode('latin-1'), data_start, size
+        # Chunks are padded to an even size
+        offset = data_start + size + (size & 1)
+
+
+def _list_chunks(data, start, size):
+    """Return the sub-chunks of a LIST chunk as {id: (data_start, size)}."""
+    return {
+        chunk_id: (chunk_start, chunk_size)
+        for chunk_id, chunk_start, chunk_size in _iter_chunks(data, start + 4, start + size)
+    }
+
+
+def _records(data, chunk, record):
+    start, size = chunk
+    return [record.unpack_from(data, start + i * record.size)
+            for i in range(size // record.size)]
+
+
+def _raw_records(data, chunk, record_size):
+    start, size = chunk
+    return [bytes(data[start + i * record_size:start + (i + 1) * record_size])
+            for i in range(size // record_size)]
+
+
+def _chunk(chunk_id, payload):
+    padding = b'\0' if len(payload) & 1 else b''
+    return _CHUNK_HEADER.pack(chunk_id.encode('latin-1'), len(payload)) + payload + padding
+
+
+def _list(list_type, chunks):
+    payload = list_type.encode('latin-1') + b''.join(chunks)
+    return _chunk('LIST', payload)
+
+
+class SoundFont:
+    """
+    Memory-mapped SoundFont file.
+
+    Only the chunk offsets and the preset/instrument/sample tables are
+    parsed; sample data is read from the map when a subset is written.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self.data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise ValueError("Empty SoundFont file")
+        try:
+            self._parse()
+        except (struct.error, KeyError) as e:
+            self.close()
+            raise ValueError(f"Invalid SoundFont file: {e}")
+
+    def _parse(self):
+        data = self.data
+        riff_id, riff_size = _CHUNK_HEADER.unpack_from(data, 0)
+        if riff_id != b'RIFF' or data[8:12] != b'sfbk':
+            raise ValueError("Not a SoundFont file")
+
+        lists = {}
+        for chunk_id, start, size in _iter_chunks(data, 12, min(len(data), 8 + riff_size)):
+            if chunk_id == 'LIST':
+                lists[bytes(data[start:start + 4]).decode('latin-1')] = (start, size)
+
+        info_start, info_size = lists['INFO']
+        # INFO is copied verbatim into subsets
+        self.info = bytes(data[info_start + 4:info_start + info_size])
+        self.sdta = _list_chunks(data, *lists['sdta'])
+        pdta = _list_chunks(data, *lists['pdta'])
+
+        self.presets = _records(data, pdta['phdr'], _PHDR)
+        self.preset_bags = _records(data, pdta['pbag'], _BAG)
+        self.preset_mods = _raw_records(data, pdta['pmod'], _MOD_SIZE)
+        self.preset_gens = _records(data, pdta['pgen'], _GEN)
+        self.instruments = _records(data, pdta['inst'], _INST)
+        self.instrument_bags = _records(data, pdta['ibag'], _BAG)
+        self.instrument_mods = _raw_records(data, pdta['imod'], _MOD_SIZE)
+        self.instrument_gens = _records(data, pdta['igen'], _GEN)
+        self.samples = _records(data, pdta['shdr'], _SHDR)
+
+    def close(self):
+        self.data.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def preset_keys(self):
+        """Return the (bank, program) pairs of all presets."""
+        return [(bank, program) for _, program, bank, *_ in self.presets[:-1]]
+
+    def _zones(self, bags, index, next_index):
+        """Yield (gens, mods) index ranges for bags[index:next_index]."""
+        for bag in range(index, next_index):
+            gen_start, mod_start = bags[bag]
+            gen_end, mod_end = bags[bag + 1]
+            yield (gen_start, gen_end), (mod_start, mod_end)
+
+    def select_presets(self, wanted):
+        """
+        Choose preset indexes for a set of (bank, program) pairs.
+
+        Programs missing from the requested bank fall back to bank 0, as
+        the synth does, and the first preset is kept if nothing matches.
+        """
+        keys = self.preset_keys()
+        selected = set()
+        for bank, program in wanted:
+            matches = [i for i, key in enumerate(keys) if key == (bank, program)]
+            if not matches and bank != PERCUSSION_BANK:
+                matches = [i for i, key in enumerate(keys) if key == (0, program)]
+            selected.update(matches)
+        if not selected and keys:
+            selected.add(0)
+        return sorted(selected)
+
+    def write_subset(self, wanted, output):
+        """
+        Write a SoundFont containing only the presets for `wanted`.
+
+        Args:
+            wanted (iterable): (bank, program) pairs to keep
+            output (file): Binary file object to write to
+        """
+        preset_indexes = self.select_presets(wanted)
+
+        # Presets -> instruments -> samples (including stereo links)
+        instrument_indexes = set()
+        for p in preset_indexes:
+            for (gen_start, gen_end), _ in self._zones(
+                    self.preset_bags, self.presets[p][3], self.presets[p + 1][3]):
+                for oper, amount in self.preset_gens[gen_start:gen_end]:
+                    if oper == GEN_INSTRUMENT:
+                        instrument_indexes.add(amount)
+        instrument_indexes = sorted(instrument_indexes)
+
+        sample_indexes = set()
+        for i in instrument_indexes:
+            for (gen_start, gen_end), _ in self._zones(
+                    self.instrument_bags, self.instruments[i][1], self.instruments[i + 1][1]):
+                for oper, amount in self.instrument_gens[gen_start:gen_end]:
+                    if oper == GEN_SAMPLE_ID:
+                        sample_indexes.add(amount)
+        for s in list(sample_indexes):
+            link, sample_type = self.samples[s][8:10]
+            if (sample_type & 0x0F) in LINKED_SAMPLE_TYPES and link < len(self.samples) - 1:
+                sample_indexes.add(link)
+        sample_indexes = sorted(sample_indexes)
+
+        instrument_map = {old: new for new, old in enumerate(instrument_indexes)}
+        sample_map = {old: new for new, old in enumerate(sample_indexes)}
+
+        phdr, pbag, pmod, pgen = self._copy_zones(
+            preset_indexes, self.presets, _PHDR, 3, self.preset_bags, self.preset_mods,
+            self.preset_gens, GEN_INSTRUMENT, instrument_map)
+        inst, ibag, imod, igen = self._copy_zones(
+            instrument_indexes, self.instruments, _INST, 1, self.instrument_bags,
+            self.instrument_mods, self.instrument_gens, GEN_SAMPLE_ID, sample_map)
+
+        phdr.append(_PHDR.pack(b'EOP', 0, 0, len(pbag), 0, 0, 0))
+        inst.append(_INST.pack(b'EOI', len(ibag)))
+        pbag.append(_BAG.pack(len(pgen), len(pmod)))
+        ibag.append(_BAG.pack(len(igen), len(imod)))
+        pmod.append(b'\0' * _MOD_SIZE)
+        imod.append(b'\0' * _MOD_SIZE)
+        pgen.append(_GEN.pack(0, 0))
+        igen.append(_GEN.pack(0, 0))
+
+        smpl, sm24, shdr = self._copy_samples(sample_indexes, sample_map)
+
+        sdta_chunks = [_chunk('smpl', smpl)]
+        if sm24 is not None:
+            sdta_chunks.append(_chunk('sm24', sm24))
+        tables = dict(phdr=phdr, pbag=pbag, pmod=pmod, pgen=pgen, inst=inst,
+                      ibag=ibag, imod=imod, igen=igen, shdr=shdr)
+        body = b'sfbk' + b''.join([
+            _list('INFO', [self.info]),
+            _list('sdta', sdta_chunks),
+            _list('pdta', [_chunk(name, b''.join(tables[name])) for name in _PDTA_ORDER]),
+        ])
+        output.write(_CHUNK_HEADER.pack(b'RIFF', len(body)))
+        output.write(body)
+
+    def _copy_zones(self, indexes, headers, header_struct, bag_field, bags,
+                    mods, gens, link_gen, link_map):
+        """Copy headers with their bags, modulators and generators, rebasing indexes."""
+        out_headers, out_bags, out_mods, out_gens = [], [], [], []
+        for index in indexes:
+            header = list(headers[index])
+            header[bag_field] = len(out_bags)
+            out_headers.append(header_struct.pack(*header))
+            for (gen_start, gen_end), (mod_start, mod_end) in self._zones(
+                    bags, headers[index][bag_field], headers[index + 1][bag_field]):
+                out_bags.append(_BAG.pack(len(out_gens), len(out_mods)))
+                out_mods.extend(mods[mod_start:mod_end])
+                for oper, amount in gens[gen_start:gen_end]:
+                    if oper == link_gen:
+                        amount = link_map[amount]
+                    out_gens.append(_GEN.pack(oper, amount))
+        return out_headers, out_bags, out_mods, out_gens
+
+    def _copy_samples(self, indexes, sample_map):
+        """Copy sample data and headers, returning (smpl, sm24, shdr records)."""
+        smpl_start, _ = self.sdta['smpl']
+        sm24 = self.sdta.get('sm24')
+        smpl_parts, sm24_parts, shdr = [], [], []
+        offset = 0  # in sample points for SF2 data, bytes for compressed data
+        byte_offset = 0
+
+        for index in indexes:
+            (name, start, end, loop_start, loop_end, rate, pitch, correction,
+             link, sample_type) = self.samples[index]
+
+            if sample_type & SAMPLE_COMPRESSED:
+                # SF3: start/end are byte offsets of the Ogg data and loop
+                # points are relative to the sample, so only start/end move
+                smpl_parts.append(self.data[smpl_start + start:smpl_start + end])
+                new_start = byte_offset
+                new_end = byte_offset + (end - start)
+                new_loop_start, new_loop_end = loop_start, loop_end
+                byte_offset = new_end
+            else:
+                # SF2: offsets are in 16-bit sample points, followed by padding
+                if byte_offset % 2:
+                    smpl_parts.append(b'\0')
+                    byte_offset += 1
+                offset = byte_offset // 2
+                smpl_parts.append(self.data[smpl_start + 2 * start:smpl_start + 2 * end])
+                smpl_parts.append(b'\0' * (2 * SAMPLE_PADDING))
+                if sm24 is not None:
+                    sm24_parts.append(self.data[sm24[0] + start:sm24[0] + end])
+                    sm24_parts.append(b'\0' * SAMPLE_PADDING)
+                new_start = offset
+                new_end = offset + (end - start)
+                new_loop_start = loop_start - start + offset
+                new_loop_end = loop_end - start + offset
+                byte_offset += 2 * (end - start + SAMPLE_PADDING)
+
+            shdr.append(_SHDR.pack(name, new_start, new_end, new_loop_start,
+                                   new_loop_end, rate, pitch, correction,
+                                   sample_map.get(link, 0), sample_type))
+
+        shdr.append(_SHDR.pack(b'EOS', 0, 0, 0, 0, 0, 0, 0, 0, 0))
+        smpl = b''.join(smpl_parts)
+        sm24_data = b''.join(sm24_parts) if sm24 is not None else None
+        return smpl, sm24_data, shdr
+
+
+def subset_cache_key(path, wanted):
+    """Key a subset by the source file identity and the sorted program set."""
+    stat = os.stat(path)
+    programs = ','.join(f'{bank}:{program}' for bank, program in sorted(set(wanted)))
+    source = f'{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}|{programs}'
+    return hashlib.sha1(source.encode('utf-8')).hexdigest()[:20]
+
+
+_build_lock = threading.Lock()
+
+
+def _evict(cache_dir, max_bytes, keep):
+    """Delete the least recently used subsets until the cache fits max_bytes."""
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.startswith('subset-') and entry.path != keep:
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    try:
+        total += os.path.getsize(keep)
+    except OSError:
+        pass
+    for _, size, subset_path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.unlink(subset_path)
+        except FileNotFoundError:
+            pass  # Evicted by another worker
+        total -= size
+
+
+def _subset_path(path, wanted, cache_dir):
+    extension = os.path.splitext(path)[1] or '.sf2'
+    return os.path.join(cache_dir, f'subset-{subset_cache_key(path, wanted)}{extension}')
+
+
+def get_subset_path(path, wanted, cache_dir=SOUNDFONT_CACHE_DIR,
+                    max_bytes=SOUNDFONT_CACHE_MAX_BYTES):
+    """
+    Return the path of a cached subset of `path`, building it if needed.
+
+    Args:
+        path (str): Source SoundFont
+        wanted (iterable): (bank, program) pairs to keep
+        cache_dir (str): Directory holding the subsets
+        max_bytes (int): Size limit of the cache directory
+
+    Returns:
+        str: Path to the subset file
+    """
+    wanted = set(wanted)
+    subset_path = _subset_path(path, wanted, cache_dir)
+    try:
+        # The modification time records the last use for eviction
+        os.utime(subset_path)
+        return subset_path
+    except FileNotFoundError:
+        pass
+
+    with _build_lock:
+        if os.path.exists(subset_path):
+            return subset_path
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write to a unique temporary file so other processes never see partial output
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as output, SoundFont(path) as soundfont:
+                soundfont.write_subset(wanted, output)
+            os.replace(tmp_path, subset_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        _evict(cache_dir, max_bytes, subset_path)
+    return subset_path
+
+
+def open_subset(path, wanted, cache_dir=SOUNDFONT_CACHE_DIR,
+                max_bytes=SOUNDFONT_CACHE_MAX_BYTES):
+    """
+    Open a cached subset of `path` for reading, building it if needed.
+
+    The open file stays readable even if another worker evicts the subset
+    while it is being sent.
+
+    Returns:
+        file: Subset opened in binary mode
+    """
+    for _ in range(3):
+        subset_path = get_subset_path(path, wanted, cache_dir, max_bytes)
+        try:
+            return open(subset_path, 'rb')
+        except FileNotFoundError:
+            continue  # Evicted between building and opening
+    raise OSError("SoundFont subset was evicted before it could be opened")
+
+
+def open_cached_subset(path, wanted, cache_dir=SOUNDFONT_CACHE_DIR):
+    """
+    Open a subset of `path` that is already built, without building it.
+
+    Returns:
+        file: Subset opened in binary mode, or None if it is not cached
+    """
+    subset_path = _subset_path(path, set(wanted), cache_dir)
+    try:
+        subset_file = open(subset_path, 'rb')
+    except FileNotFoundError:
+        return None
+    try:
+        os.utime(subset_path)
+    except FileNotFoundError:
+        pass  # Evicted after opening; the open file is still readable
+    return subset_file
@@ -28046,15 +28046,34 @@ async function Uh(n) {
       (Qr = !0);
   }
   Kt.innerText = "Loading soundfont...";
-  let t = await _d(
-    n,
-    (i) => (Gh.style.width = `${(i / 100) * Kt.offsetWidth}px`)
-  );
-  (Kt.innerText = "Parsing soundfont..."),
+  let t;
+  try {
+    t = await _d(
+      n,
+      (i) => (Gh.style.width = `${(i / 100) * Kt.offsetWidth}px`)
+    );
+  } catch (i) {
+    // Building a subset can be refused while the server is busy: use the full bank
+    let s = Er.find((o) => !o.name.startsWith("/soundfonts/subset/"));
+    if (!n.startsWith("/soundfonts/subset/") || !s) throw i;
+    return (document.getElementById("sf_selector").value = s.name), Uh(s.name);
+  }
+  Kt.innerText = "Parsing soundfont...";
+  let i = new Promise((s) =>
     setTimeout(() => {
-      (window.soundFontParser = t), (Gh.style.width = "0"), e();
-    }),
-    (Kt.innerText = window.TITLE);
+      (window.soundFontParser = t), (Gh.style.width = "0"), e().finally(s);
+    })
+  );
+  (Kt.innerText = window.TITLE), await i;
+}
+// Uploaded MIDI files can use any General MIDI preset, so switch from a
+// per-instrument subset to the full bank before playing them
+async function Wf() {
+  let n = document.getElementById("sf_selector"),
+    e = Er.find((t) => !t.name.startsWith("/soundfonts/subset/"));
+  e &&
+    n.value.startsWith("/soundfonts/subset/") &&
+    ((n.value = e.name), await Uh(e.name));
 }
 document.body.onclick = async () => {
   if (!window.audioContextMain) {
@@ -28079,7 +28098,7 @@ document.body.onclick = async () => {
 };
 var Er = [],
   Oh = new ao(navigator.language.split("-")[0].toLowerCase());
-fetch("soundfonts").then(async (n) => {
+fetch(window.SOUNDFONTS_URL || "soundfonts").then(async (n) => {
   if (!n.ok)
     throw ((Kt.innerText = "Error fetching soundfonts!"), n.statusText);
   let e = document.getElementById("sf_selector");
@@ -28101,9 +28120,9 @@ fetch("soundfonts").then(async (n) => {
         (Kt.innerText = window.manager.seq.midiData.midiName || window.TITLE);
   }),
     await Uh(Er[0].name),
-    ci.files[0] && (await yr(ci.files)),
+    ci.files[0] && (await Wf(), await yr(ci.files)),
     (ci.onchange = async () => {
-      ci.files[0] && (await yr(ci.files));
+      ci.files[0] && (await Wf(), await yr(ci.files));
     });
 });
 function $d(n) {
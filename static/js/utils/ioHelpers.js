@@ -12,6 +12,9 @@ let progressBar = null;
 let progressText = null;
 let progressDetails = null;
 
+// Last MIDI export, used to send only changed measures on the next export
+let lastMidiExport = null;
+
 // Initialize file handlers with progress UI
 export function initializeFileHandlers() {
     const fileInput = document.getElementById('load-file');
@@ -556,15 +559,26 @@ export function exportMidi() {
         })
     };
 
-    fetch('/convert-to-midi', {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify(vexflowJson)
+    const { measures, ...metadata } = vexflowJson;
+    const measureStrings = measures.map(measure => JSON.stringify(measure));
+    const metadataString = JSON.stringify(metadata);
+
+    postMidiExport(vexflowJson, measureStrings, metadataString)
+    .then(response => {
+        // The server may no longer have our base version (expired from its cache)
+        if (response.status === 409) {
+            lastMidiExport = null;
+            return postMidiExport(vexflowJson, measureStrings, metadataString);
+        }
+        return response;
     })
     .then(response => {
         if (!response.ok) {
+            lastMidiExport = null;
             throw new Error('Failed to export MIDI file.');
         }
+        const version = response.headers.get('X-Score-Version');
+        lastMidiExport = version ? { version, measureStrings, metadataString } : null;
         return response.blob();
     })
     .then(blob => {
@@ -582,6 +596,32 @@ export function exportMidi() {
     });
 }
 
+// Send the full song, or only the changed measures if the server has our last export
+function postMidiExport(vexflowJson, measureStrings, metadataString) {
+    let body;
+    if (lastMidiExport && lastMidiExport.metadataString === metadataString) {
+        const changedMeasures = {};
+        measureStrings.forEach((measureString, index) => {
+            if (lastMidiExport.measureStrings[index] !== measureString) {
+                changedMeasures[index] = vexflowJson.measures[index];
+            }
+        });
+        body = {
+            baseVersion: lastMidiExport.version,
+            measureCount: measureStrings.length,
+            changedMeasures
+        };
+    } else {
+        body = vexflowJson;
+    }
+
+    return fetch('/convert-to-midi', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify(body)
+    });
+}
+
 // Save to localStorage
 export function saveToLocalStorage() {
     const activeScore = scoreManager.getActiveScore();
@@ -592,7 +632,8 @@ export function saveToLocalStorage() {
             measures: activeScore.measures,
             keySignature: activeScore.metadata.keySignature,
             isMinorChordMode: activeScore.metadata.isMinorChordMode,
-            timeSignature: activeScore.metadata.timeSignature
+            timeSignature: activeScore.metadata.timeSignature,
+            instrument: activeScore.metadata.instrument || pianoState.instrument
         };
     } else {
         scoreData = {
@@ -602,7 +643,8 @@ export function saveToLocalStorage() {
             timeSignature: {
                 numerator: pianoState.timeSignature.numerator,
                 denominator: pianoState.timeSignature.denominator
-            }
+            },
+            instrument: pianoState.instrument
         };
     }
     
@@ -89,9 +89,32 @@ async waitForLibraries() {
         console.log('✅ Connected to HTML elements');
     }
 
+    getSongInstrument() {
+        // Instrument of the autosaved song, used to pick a SoundFont subset
+        try {
+            const savedData = JSON.parse(localStorage.getItem('autosavedScore') || '{}');
+            if (savedData && typeof savedData.instrument === 'string' && savedData.instrument) {
+                return savedData.instrument;
+            }
+        } catch (error) {
+            console.log('⚠️ Could not read autosaved score instrument');
+        }
+        return 'piano';
+    }
+
     async preloadSoundFont() {
         try {
-            const response = await fetch('/static/soundfonts/default.sf3');
+            // The server lists a subset with only this instrument's presets
+            const instrument = encodeURIComponent(this.getSongInstrument());
+            const listResponse = await fetch(`/soundfonts?instrument=${instrument}`);
+            const soundFonts = listResponse.ok ? await listResponse.json() : [];
+            const soundFontUrl = soundFonts[0]?.name || '/static/soundfonts/default.sf3';
+
+            let response = await fetch(soundFontUrl);
+            if (!response.ok && soundFontUrl !== '/static/soundfonts/default.sf3') {
+                // Building the subset can be refused while the server is busy
+                response = await fetch('/static/soundfonts/default.sf3');
+            }
             if (response.ok) {
                 this.soundFontBuffer = await response.arrayBuffer();
                 console.log('✅ SoundFont preloaded');